@@ -1,10 +1,26 @@
 import os
+import asyncio
+import base64
+import contextlib
 from dotenv import load_dotenv
 import boto3
-import json
+from aiobotocore.config import AioConfig
+from aiobotocore.session import get_session
+import orjson
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from typing import Literal
-import traceback
+import functools
+import hashlib
+import mmap
+import queue
+import re
+import tempfile
+import threading
+import time
+import uuid
 import logging
 
 load_dotenv()
@@ -20,6 +36,25 @@ logger = logging.getLogger(__name__)
 # Guardrail limits image file size up to 4 MB
 MAX_IMAGE_SIZE = 4 * 1024 * 1024
 
+# Concurrent HTTPS connections to Bedrock, and worker threads using them
+BEDROCK_MAX_CONNECTIONS = 64
+
+# Concurrent HTTPS connections held by each AsyncGuard's aiohttp connector
+ASYNC_MAX_CONNECTIONS = 32
+
+# Leading bytes of the image formats the guards accept
+JPEG_MAGIC = b'\xff\xd8\xff'
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+# Number of guard verdicts remembered for repeated content
+VERDICT_CACHE_SIZE = 10_000
+
+# Nova is asked at most this many times when it answers off-format; retries back off
+# exponentially from NOVA_RETRY_DELAY seconds. Throttling is retried by the client itself
+MAX_NOVA_ATTEMPTS = 3
+NOVA_RETRY_DELAY = 0.1
+THROTTLING_CODES = ('ThrottlingException', 'ServiceUnavailableException', 'TooManyRequestsException')
+
 aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
 aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
 aws_session_token = os.getenv('AWS_SESSION_TOKEN', None)
@@ -27,6 +62,12 @@ region = os.getenv('REGION', 'us-east-1')
 guardrail_identifier = os.getenv('GUARDRAIL_IDENTIFIER')
 guardrail_version = os.getenv('GUARDRAIL_VERSION')
 MODEL_ID = os.getenv('MODEL_ID')
+# Coalesce concurrent Nova text checks into shared converse calls
+NOVA_TEXT_BATCHING = os.getenv('NOVA_TEXT_BATCHING', 'false').lower() == 'true'
+# Nova system prompt: 'short' (default) or 'lisp', the original long prompt
+NOVA_PROMPT = os.getenv('NOVA_PROMPT', 'short').lower()
+# Still ask Nova for a second opinion on content the guardrail already blocked
+NOVA_RECHECK_INTERVENED = os.getenv('NOVA_RECHECK_INTERVENED', 'false').lower() == 'true'
 
 # Create a Boto3 session and bedrock runtime
 session = boto3.Session(
@@ -36,9 +77,103 @@ session = boto3.Session(
     region_name=region
 )
 
-bedrock_runtime = session.client('bedrock-runtime')
+# One client for all calls: concurrent guard calls reuse pooled keep-alive HTTPS
+# connections, adaptive retries throttle client-side, and tight timeouts bound the tail
+bedrock_runtime = session.client(
+    'bedrock-runtime',
+    config=Config(
+        max_pool_connections=BEDROCK_MAX_CONNECTIONS,
+        retries={'max_attempts': 3, 'mode': 'adaptive'},
+        connect_timeout=3,
+        read_timeout=10,
+        tcp_keepalive=True
+    )
+)
 
+# Shared pool for fanning out the independent guard calls in guard(),
+# sized so every worker can hold a pooled connection
+executor = ThreadPoolExecutor(max_workers=BEDROCK_MAX_CONNECTIONS, thread_name_prefix='guard')
+
+class VerdictCache:
+    """Thread-safe LRU of guard verdicts."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, verdict):
+        with self.lock:
+            self.entries[key] = verdict
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+verdict_cache = VerdictCache(VERDICT_CACHE_SIZE)
+
+class FallbackVerdict(str):
+    """A verdict assumed because Nova gave no usable answer (throttled or off-format).
+    It compares equal to the real verdict but is never cached, since a retry later may
+    well get a real answer."""
+
+# What nova_verdict() returns when it runs out of attempts
+FALLBACK_NONE = FallbackVerdict('NONE')
+
+def is_fallback(verdict):
+    verdicts = verdict if isinstance(verdict, tuple) else (verdict,)
+    return any(isinstance(v, FallbackVerdict) for v in verdicts)
+
+def verdict_key(name, guard_content, *args):
+    """Cache key for a guard verdict: a digest of the content rather than the content
+    itself, plus the guardrail version and model so a policy change misses the cache."""
+    data = guard_content.encode() if isinstance(guard_content, str) else guard_content
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    return (name, digest, *args, guardrail_version, MODEL_ID)
+
+def cached_verdict(guard_fn):
+    """Memoizes a guard function on a digest of its content. Verdicts are deterministic
+    (temperature 0, top-k 1), and the key includes the guardrail version and model so a
+    policy change is never answered from stale entries. Exceptions and fallback
+    verdicts are not cached."""
+    @functools.wraps(guard_fn)
+    def wrapper(guard_content, *args):
+        key = verdict_key(guard_fn.__name__, guard_content, *args)
+
+        verdict = verdict_cache.get(key)
+        if verdict is None:
+            verdict = guard_fn(guard_content, *args)
+            if not is_fallback(verdict):
+                verdict_cache.put(key, verdict)
+        return verdict
+    return wrapper
+
+def cached_verdict_async(guard_fn):
+    """cached_verdict for the coroutine guards, which take the client first. They share
+    entries with their sync counterparts (same name without the _async suffix)."""
+    name = guard_fn.__name__.removesuffix('_async')
+
+    @functools.wraps(guard_fn)
+    async def wrapper(client, guard_content, *args):
+        key = verdict_key(name, guard_content, *args)
+
+        verdict = verdict_cache.get(key)
+        if verdict is None:
+            verdict = await guard_fn(client, guard_content, *args)
+            if not is_fallback(verdict):
+                verdict_cache.put(key, verdict)
+        return verdict
+    return wrapper
+
+@cached_verdict
 def guard_text(guard_content: str):
+    """Applies the guardrail alone; used when Nova text checks are batched."""
     response = bedrock_runtime.apply_guardrail(
         guardrailIdentifier=guardrail_identifier,
         guardrailVersion=guardrail_version,
@@ -54,32 +189,10 @@ def guard_text(guard_content: str):
             },
         ]
     )
-    return response
-
-def guard_image(guard_blob, img_format: Literal['png', 'jpeg']):
-    # Check image size before sending the request
-    image_size = len(guard_blob)
-    if image_size > MAX_IMAGE_SIZE:
-        raise ValueError(f'Image size ({image_size} bytes) exceeds the maximum allowed size ({MAX_IMAGE_SIZE} bytes)')
-
-    response = bedrock_runtime.apply_guardrail(
-        guardrailIdentifier=guardrail_identifier,
-        guardrailVersion=guardrail_version,
-        source='INPUT',
-        content=[
-            {
-                'image': {
-                    'format': img_format,
-                    'source': {
-                        'bytes': guard_blob,
-                    }
-                }
-            },
-        ]
-    )
-    return response
+    return response['action']
 
-SYSTEM_PROMPT = """;; You are a Guardrails judge, making judgements based on the given functions
+# Original prompt, kept for A/B comparison against the short one (NOVA_PROMPT=lisp)
+LISP_SYSTEM_PROMPT = """;; You are a Guardrails judge, making judgements based on the given functions
 ;; First, define our main guardrailing check function.
 ;; It strictly returns only "GUARDRAIL_INTERVENED" or "NONE".
 (defun guardrail-check (content)
@@ -143,183 +256,715 @@ SYSTEM_PROMPT = """;; You are a Guardrails judge, making judgements based on the
      do (setf result (guardrail-check content))
      finally (return result)))"""
 
-def guard_nova_text(guard_content: str):
-    # Your existing system prompt & messages
-    system = [{ 
-        'text': SYSTEM_PROMPT
-    }]
+# Says nothing about how many answers to give, so it serves both the single checks
+# and guard_nova_text_batch(), whose request asks for one line per content
+SHORT_SYSTEM_PROMPT = (
+    'Classify each input content. Its label is GUARDRAIL_INTERVENED if it violates any of '
+    '{hate, sexual, illegal, violence, misinformation, harassment, PII, spam, impersonation, IP}; '
+    'otherwise NONE. Reply with labels only, one per line, one line per content.'
+)
+
+SYSTEM_PROMPT = LISP_SYSTEM_PROMPT if NOVA_PROMPT == 'lisp' else SHORT_SYSTEM_PROMPT
+# The Lisp prompt is invoked by name at the end of each request
+NOVA_CALL = '\n (guardrail-check-with-loop content)' if NOVA_PROMPT == 'lisp' else ''
+
+# Request pieces shared by every Nova call; botocore does not mutate them
+NOVA_SYSTEM = ({'text': SYSTEM_PROMPT},)
+NOVA_INF_PARAMS = {'maxTokens': 300, 'topP': 1.0, 'temperature': 0.0}
+NOVA_EXTRA_FIELDS = {'inferenceConfig': {'topK': 1}}
+NOVA_GUARDRAIL_CONFIG = {
+    'guardrailIdentifier': guardrail_identifier,
+    'guardrailVersion': guardrail_version
+}
+NOVA_ANSWER_RULE = (
+    'In your answer, include only GUARDRAIL_INTERVENED or NONE in plain text. '
+    'Do not include any other character.\n'
+)
+NOVA_TEXT_PREFIX = NOVA_ANSWER_RULE + 'content= "'
+NOVA_TEXT_SUFFIX = '"' + NOVA_CALL
+NOVA_IMAGE_PROMPT = NOVA_ANSWER_RULE + 'content= image' + NOVA_CALL
+# Constant content blocks, shared by every request; only the user's
+# content is built per call
+NOVA_TEXT_PREFIX_BLOCK = {'text': NOVA_TEXT_PREFIX}
+NOVA_TEXT_SUFFIX_BLOCK = {'text': NOVA_TEXT_SUFFIX}
+NOVA_IMAGE_PROMPT_BLOCK = {'text': NOVA_IMAGE_PROMPT}
+
+# Nova occasionally pads its answer, e.g. 'NONE\n'
+VERDICT_RE = re.compile(r'\s*(GUARDRAIL_INTERVENED|NONE)\b')
+
+def converse_nova(messages, guardrail_config=None):
+    """Sends messages to Nova with the shared system prompt and settings, optionally
+    behind the guardrail; returns the full response."""
+    guardrail = {'guardrailConfig': guardrail_config} if guardrail_config else {}
+    model_response = bedrock_runtime.converse(
+        modelId=MODEL_ID,
+        messages=messages,
+        system=NOVA_SYSTEM,
+        inferenceConfig=NOVA_INF_PARAMS,
+        additionalModelRequestFields=NOVA_EXTRA_FIELDS,
+        **guardrail
+    )
+
+    # Only pay for serializing the response when it will actually be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('\n[Full Response]\n%s', orjson.dumps(model_response, option=orjson.OPT_INDENT_2).decode())
+    return model_response
+
+def response_text(model_response):
+    # Extract just the text from the model's response
+    return model_response['output']['message']['content'][0]['text']
+
+def parse_verdict(result_text):
+    """Returns 'GUARDRAIL_INTERVENED' or 'NONE' from Nova's reply, or None if it is off-format."""
+    logger.debug('\n[Response Content Text]\n%s', result_text)
 
+    # Check if the text is one of the two valid outputs, ignoring surrounding whitespace
+    match = VERDICT_RE.match(result_text)
+    return match.group(1) if match else None
+
+def retry_delay(attempt):
+    """Seconds to wait after a failed attempt: exponential backoff."""
+    return NOVA_RETRY_DELAY * (2 ** attempt)
+
+def is_throttled(error):
+    return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLING_CODES
+
+def nova_verdict(messages, attempts=MAX_NOVA_ATTEMPTS):
+    """Asks Nova until it answers 'GUARDRAIL_INTERVENED' or 'NONE', at most attempts times.
+    Falls back to 'NONE' so a flaky model never blocks the guardrail's verdict."""
+    for attempt in range(attempts):
+        try:
+            verdict = parse_verdict(response_text(converse_nova(messages)))
+            if verdict is not None:
+                return verdict
+            # If it's anything else, re-try
+            logger.error('Unexpected response. Retrying...')
+
+        except Exception as e:
+            if not is_throttled(e):
+                # Log the error with its stack trace, then raise the error
+                logger.exception('Bedrock converse failed: %s', e)
+                raise
+            # The client has already retried the throttling with adaptive backoff
+            logger.warning('Model request still throttled after client retries; assuming NONE')
+            return FALLBACK_NONE
+
+        if attempt + 1 < attempts:
+            time.sleep(retry_delay(attempt))
+
+    logger.warning('No valid response from the model after %d attempts; assuming NONE', attempts)
+    return FALLBACK_NONE
+
+def guarded_verdicts(guarded_messages, messages):
+    """Applies the guardrail and asks Nova in a single converse call; returns the
+    (guardrails, nova) verdicts. A request the guardrail blocks never reaches Nova,
+    so Nova is only asked on its own, with the unguarded messages, if
+    NOVA_RECHECK_INTERVENED is set; otherwise its verdict is left at 'NONE'."""
+    model_response = converse_nova(guarded_messages, NOVA_GUARDRAIL_CONFIG)
+    if model_response['stopReason'] == 'guardrail_intervened':
+        if not NOVA_RECHECK_INTERVENED:
+            return 'GUARDRAIL_INTERVENED', 'NONE'
+        return 'GUARDRAIL_INTERVENED', nova_verdict(messages)
+
+    verdict = parse_verdict(response_text(model_response))
+    if verdict is None:
+        logger.error('Unexpected response. Retrying...')
+        time.sleep(retry_delay(0))
+        verdict = nova_verdict(messages, MAX_NOVA_ATTEMPTS - 1)
+    return 'NONE', verdict
+
+def nova_text_messages(guard_content: str):
+    """Returns the (guarded, unguarded) Nova messages for a text check."""
+    # Only the user content goes through the guardrail, not the instructions around it
+    guarded_messages = [
+        {
+            'role': 'user',
+            'content': [
+                NOVA_TEXT_PREFIX_BLOCK,
+                {
+                    'guardContent': {
+                        'text': {
+                            'text': guard_content,
+                            'qualifiers': [
+                                'guard_content',
+                            ]
+                        }
+                    }
+                },
+                NOVA_TEXT_SUFFIX_BLOCK
+            ],
+        }
+    ]
+    messages = [
+        {
+            'role': 'user',
+            'content': [
+                {
+                    'text': NOVA_TEXT_PREFIX + guard_content + NOVA_TEXT_SUFFIX
+                }
+            ],
+        }
+    ]
+    return guarded_messages, messages
+
+@cached_verdict
+def guard_nova_text(guard_content: str):
+    return guarded_verdicts(*nova_text_messages(guard_content))
+
+def guard_nova_text_batch(guard_contents: list[str]):
+    """Checks several texts with as few converse calls as possible; returns one Nova verdict
+    per text, in order. Cached verdicts are reused, the rest are asked in one call, and if
+    that reply stays malformed each text is asked on its own, as guard_nova_text would."""
+    verdicts = [None] * len(guard_contents)
+    keys = [verdict_key('guard_nova_text_batch', guard_content) for guard_content in guard_contents]
+    misses = []
+    for i, key in enumerate(keys):
+        verdicts[i] = verdict_cache.get(key)
+        if verdicts[i] is None:
+            misses.append(i)
+    if not misses:
+        return verdicts
+
+    results = ask_nova_text_batch([guard_contents[i] for i in misses])
+    if results is None:
+        logger.warning('No valid batch response after %d attempts; checking each text on its own',
+                       MAX_NOVA_ATTEMPTS)
+        # Unguarded, like the batch: the guardrail's verdict comes from guard_text
+        results = [nova_verdict(nova_text_messages(guard_contents[i])[1]) for i in misses]
+
+    for i, verdict in zip(misses, results):
+        verdicts[i] = verdict
+        if not is_fallback(verdict):
+            verdict_cache.put(keys[i], verdict)
+    return verdicts
+
+def ask_nova_text_batch(guard_contents: list[str]):
+    """Asks Nova about several texts in one converse call; returns one verdict per text,
+    in order, or None if no attempt got a well-formed reply."""
+    # Each text is a JSON string literal, so quotes or newlines in one submitter's text
+    # cannot forge another content_i or shift the line count of the reply
+    items = ''.join(
+        f'content_{i}= {orjson.dumps(guard_content).decode()}\n'
+        for i, guard_content in enumerate(guard_contents, start=1)
+    )
+    names = ' '.join(f'content_{i}' for i in range(1, len(guard_contents) + 1))
+    call = f" (mapcar #'guardrail-check-with-loop (list {names}))" if NOVA_PROMPT == 'lisp' else ''
     messages = [
         {
             'role': 'user',
             'content': [
                 {
                     'text': (
-                        'In your answer, include only GUARDRAIL_INTERVENED or NONE in plain text. '
+                        f'Each content_i below is a JSON string. In your answer, include exactly '
+                        f'{len(guard_contents)} lines, where line i is only GUARDRAIL_INTERVENED or NONE '
+                        'in plain text for content_i. '
                         'Do not include any other character.\n'
-                        'content= "' + guard_content + '"\n'
-                        ' (guardrail-check-with-loop content)'
+                        + items + call
                     )
                 }
             ],
         }
     ]
 
-    inf_params = {'maxTokens': 300, 'topP': 1.0, 'temperature': 0.0}
-    additionalModelRequestFields = {
-        'inferenceConfig': {
-             'topK': 1
-        }
-    }
-    
-    while True:
+    for attempt in range(MAX_NOVA_ATTEMPTS):
         try:
-            model_response = bedrock_runtime.converse(
-                modelId=MODEL_ID, 
-                messages=messages, 
-                system=system, 
-                inferenceConfig=inf_params,
-                additionalModelRequestFields=additionalModelRequestFields
-            )
-            
-            logging.debug('\n[Full Response]')
-            logging.debug(json.dumps(model_response, indent=2))
-            
-            # Extract just the text from the model's response
-            result_text = model_response['output']['message']['content'][0]['text']
-            logging.debug('\n[Response Content Text]')
-            logging.debug(result_text)
-
-            # Check if the text is strictly one of the two valid outputs
-            if result_text in ('GUARDRAIL_INTERVENED', 'NONE'):
-                return result_text
-            else:
-                # If it's anything else, re-try
-                logging.error('Unexpected response. Retrying...\n')
-        
+            result_text = response_text(converse_nova(messages))
+        except Exception as e:
+            if not is_throttled(e):
+                # Log the error with its stack trace, then raise the error
+                logger.exception('Bedrock converse failed: %s', e)
+                raise
+            # The client has already retried the throttling with adaptive backoff
+            logger.warning('Model request still throttled after client retries; assuming NONE')
+            return [FALLBACK_NONE] * len(guard_contents)
+
+        matches = [VERDICT_RE.match(line) for line in result_text.splitlines() if line.strip()]
+
+        # Every line must be one of the two valid outputs, one per content
+        if len(matches) == len(guard_contents) and all(matches):
+            return [match.group(1) for match in matches]
+        logger.error('Unexpected batch response. Retrying...')
+        if attempt + 1 < MAX_NOVA_ATTEMPTS:
+            time.sleep(retry_delay(attempt))
+
+    return None
+
+class NovaTextBatcher:
+    """Micro-batches concurrent Nova text checks: waits up to max_wait_ms for up to max_batch
+    texts, sends them in one guard_nova_text_batch call and resolves each caller's future."""
+
+    def __init__(self, max_batch=8, max_wait_ms=50):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self.collect, name='nova-batcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, guard_content: str):
+        future = Future()
+        self.pending.put((guard_content, future))
+        return future
+
+    def collect(self):
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            # Send from the shared pool so the next batch can fill in the meantime
+            executor.submit(self.send, batch)
+
+    def send(self, batch):
+        # Drop texts whose caller no longer needs the verdict
+        batch = [(guard_content, future) for guard_content, future in batch
+                 if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = guard_nova_text_batch([guard_content for guard_content, _ in batch])
         except Exception as e:
-            # Log the error, log the stack trace, then raise the error
-            logging.error('An error occurred while requesting the model:\n', str(e))
-            traceback.print_exc()
-            raise e
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
 
-def guard_nova_image(guard_blob, img_format: Literal['png', 'jpeg']):
-    # Your existing system prompt & messages
-    system = [{ 
-        'text': SYSTEM_PROMPT
-    }]
+nova_text_batcher = NovaTextBatcher() if NOVA_TEXT_BATCHING else None
 
-    messages = [
+def nova_image_messages(guard_blob, img_format: Literal['png', 'jpeg']):
+    """Returns the (guarded, unguarded) Nova messages for an image check."""
+    # Check image size before sending the request
+    image_size = len(guard_blob)
+    if image_size > MAX_IMAGE_SIZE:
+        raise ValueError(f'Image size ({image_size} bytes) exceeds the maximum allowed size ({MAX_IMAGE_SIZE} bytes)')
+
+    image = {
+        'format': img_format,
+        'source': {
+            'bytes': guard_blob
+        }
+    }
+
+    # The guardrail runs inline on this converse call, so the image is sent, and
+    # base64-encoded by botocore, once per check rather than once per guard.
+    # Only the image goes through the guardrail, not the instructions around it
+    guarded_messages = [
         {
             'role': 'user',
             'content': [
+                NOVA_IMAGE_PROMPT_BLOCK,
                 {
-                    'text': (
-                        'In your answer, include only GUARDRAIL_INTERVENED or NONE in plain text. '
-                        'Do not include any other character.\n'
-                        'content= image\n'
-                        '(guardrail-check-with-loop content)'
-                    )
-                },
+                    'guardContent': {
+                        'image': image
+                    }
+                }
+            ],
+        }
+    ]
+    messages = [
+        {
+            'role': 'user',
+            'content': [
+                NOVA_IMAGE_PROMPT_BLOCK,
                 {
-                        'image': {
-                            'format': 'jpeg',
-                            'source': {
-                                'bytes': guard_blob
-                            }
-                        }
+                    'image': image
                 }
             ],
         }
     ]
+    return guarded_messages, messages
 
-    inf_params = {'maxTokens': 300, 'topP': 1.0, 'temperature': 0.0}
-    additionalModelRequestFields = {
-        'inferenceConfig': {
-             'topK': 1
-        }
-    }
-    
-    while True:
-        try:
-            model_response = bedrock_runtime.converse(
-                modelId=MODEL_ID, 
-                messages=messages, 
-                system=system, 
-                inferenceConfig=inf_params,
-                additionalModelRequestFields=additionalModelRequestFields
-            )
-            
-            logging.debug('\n[Full Response]')
-            logging.debug(json.dumps(model_response, indent=2))
-            
-            # Extract just the text from the model's response
-            result_text = model_response['output']['message']['content'][0]['text']
-            logging.debug('\n[Response Content Text]')
-            logging.debug(result_text)
-
-            # Check if the text is strictly one of the two valid outputs
-            if result_text in ('GUARDRAIL_INTERVENED', 'NONE'):
-                return result_text
-            else:
-                # If it's anything else, re-try
-                logging.error('Unexpected response. Retrying...\n')
-        
-        except Exception as e:
-            # Log the error, log the stack trace, then raise the error
-            logging.error('An error occurred while requesting the model:\n', str(e))
-            traceback.print_exc()
-            raise e
-
-def handle_image(decision, img_path):
-    """Reads image, decides extension, and updates decision dict accordingly."""
-    if not os.path.exists(img_path):
-        logging.warning('File does not exist: %s; proceed without image', img_path)
-        return
-
-    with open(img_path, 'rb') as f:
-        img_blob = f.read()
-
-    # Determine extension: 'jpeg' for JPG/JPEG, 'png' for PNG,
-    # otherwise None (unsupported)
+@cached_verdict
+def guard_nova_image(guard_blob, img_format: Literal['png', 'jpeg']):
+    return guarded_verdicts(*nova_image_messages(guard_blob, img_format))
+
+def handle_image(img_path):
+    """Maps image and decides extension; returns (img_blob, ext), or None if the image is unusable.
+    The caller closes img_blob once the guard calls using it are done."""
+    try:
+        size = os.stat(img_path).st_size
+    except FileNotFoundError:
+        logger.warning('File does not exist: %s; proceed without image', img_path)
+        return None
+
+    # Reject unusable files from their size alone, before touching the contents
+    if size == 0:
+        logger.warning('File is empty: %s; proceed without image', img_path)
+        return None
+    if size > MAX_IMAGE_SIZE:
+        logger.warning(
+            'Image size (%d bytes) exceeds the maximum allowed size (%d bytes): %s; proceed without image',
+            size, MAX_IMAGE_SIZE, img_path
+        )
+        return None
+
+    # Map the file rather than reading it: botocore base64-encodes straight
+    # from the page cache without an intermediate bytes copy
+    fd = os.open(img_path, os.O_RDONLY)
+    try:
+        img_blob = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+    # Determine extension from the file signature: 'jpeg' for JPG/JPEG,
+    # 'png' for PNG, otherwise None (unsupported)
     ext = (
-        'jpeg' if ('jpg' in img_path.lower() or 'jpeg' in img_path.lower())
-        else 'png' if 'png' in img_path.lower()
+        'jpeg' if img_blob[:3] == JPEG_MAGIC
+        else 'png' if img_blob[:8] == PNG_MAGIC
         else None
     )
 
     if ext is None:
-        logging.warning('warning: image type not supported; proceed without image')
-        return
-
-    # Call the guard functions (each returns 'GUARDRAIL_INTERVENED' or 'NONE')
-    img_result = guard_image(img_blob, ext)
-    if img_result == 'GUARDRAIL_INTERVENED':
-        decision['guardrails'] = 'GUARDRAIL_INTERVENED'
+        img_blob.close()
+        logger.warning('warning: image type not supported; proceed without image')
+        return None
 
-    nova_img_result = guard_nova_image(img_blob, ext)
-    if nova_img_result == 'GUARDRAIL_INTERVENED':
-        decision['nova'] = 'GUARDRAIL_INTERVENED'
+    return img_blob, ext
 
-def guard(guard_content=None, img_path=None):
-    """Decides if any guard (text/image) triggers an intervention, storing outcome in decision."""
-    decision = {'guardrails': 'NONE', 'nova': 'NONE'}
+def submit_guards(guard_content=None, image=None):
+    """Dispatches the independent guard calls and maps each future to the decision key(s)
+    its verdict(s) may set."""
+    futures = {}
 
     # 1. Check text (if provided)
     if guard_content is not None:
-        text_result = guard_text(guard_content)
-        if text_result == 'GUARDRAIL_INTERVENED':
-            decision['guardrails'] = 'GUARDRAIL_INTERVENED'
-    
-        nova_text_result = guard_nova_text(guard_content)
-        if nova_text_result == 'GUARDRAIL_INTERVENED':
-            decision['nova'] = 'GUARDRAIL_INTERVENED'
+        if nova_text_batcher is not None:
+            # A batched Nova call cannot attribute a guardrail block to one text,
+            # so the guardrail is applied on its own
+            futures[executor.submit(guard_text, guard_content)] = 'guardrails'
+            futures[nova_text_batcher.submit(guard_content)] = 'nova'
+        else:
+            futures[executor.submit(guard_nova_text, guard_content)] = ('guardrails', 'nova')
 
     # 2. Check image (if provided)
-    if img_path is not None:
-        handle_image(decision, img_path)
+    if image is not None:
+        img_blob, ext = image
+        futures[executor.submit(guard_nova_image, img_blob, ext)] = ('guardrails', 'nova')
+
+    return futures
+
+def record_verdicts(decision, keys, verdicts):
+    """Marks each decision key whose verdict is 'GUARDRAIL_INTERVENED'; keys and verdicts
+    are either a single key and verdict or matching tuples."""
+    if isinstance(keys, str):
+        keys, verdicts = (keys,), (verdicts,)
+    for key, verdict in zip(keys, verdicts):
+        if verdict == 'GUARDRAIL_INTERVENED':
+            decision[key] = 'GUARDRAIL_INTERVENED'
+
+def short_circuits(decision):
+    """True once the guardrail has blocked and Nova's second opinion is not wanted,
+    so the remaining guard calls add nothing to the decision."""
+    return not NOVA_RECHECK_INTERVENED and decision['guardrails'] == 'GUARDRAIL_INTERVENED'
+
+class GuardRequest:
+    """State of one guard() request: the decision, the dispatched guard calls, and the
+    image mapping the image calls read from."""
+
+    def __init__(self, guard_content=None, img_path=None):
+        self.decision = {'guardrails': 'NONE', 'nova': 'NONE'}
+        self.image = None
+        self.image_futures = {}
+
+        # Read the image in the background so the disk I/O overlaps the text call
+        self.image_read = executor.submit(handle_image, img_path) if img_path is not None else None
+        self.futures = submit_guards(guard_content)
+
+    def add_image(self, image):
+        """Dispatches the image calls once the read started in __init__ has finished."""
+        self.image = image
+        self.image_futures = submit_guards(image=image)
+        self.futures.update(self.image_futures)
+
+    def record(self, future):
+        """Records a finished call's verdicts; returns True once the decision short-circuits,
+        after dropping the calls that have not started yet."""
+        record_verdicts(self.decision, self.futures[future], future.result())
+        if not short_circuits(self.decision):
+            return False
+        for pending in self.futures:
+            pending.cancel()
+        return True
+
+    def release(self):
+        """Closes the image mapping once no call can still be reading it, without waiting:
+        the last image call to finish (or be cancelled) closes it."""
+        if self.image is None:
+            return
+        remaining = len(self.image_futures)
+        lock = threading.Lock()
+
+        def close_when_done(_):
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                if remaining == 0:
+                    self.image[0].close()
+
+        # Runs at once for futures that have already finished
+        for future in self.image_futures:
+            future.add_done_callback(close_when_done)
+
+def guard(guard_content=None, img_path=None):
+    """Decides if any guard (text/image) triggers an intervention, storing outcome in decision."""
+    request = GuardRequest(guard_content, img_path)
+    request.add_image(request.image_read.result() if request.image_read is not None else None)
+
+    try:
+        for future in as_completed(request.futures):
+            # Calls still running once the decision short-circuits are not waited for
+            if not future.cancelled() and request.record(future):
+                break
+    finally:
+        request.release()
+
+    return request.decision
+
+async def converse_nova_async(client, messages, guardrail_config=None):
+    """converse_nova() on an aiobotocore client."""
+    guardrail = {'guardrailConfig': guardrail_config} if guardrail_config else {}
+    model_response = await client.converse(
+        modelId=MODEL_ID,
+        messages=messages,
+        system=NOVA_SYSTEM,
+        inferenceConfig=NOVA_INF_PARAMS,
+        additionalModelRequestFields=NOVA_EXTRA_FIELDS,
+        **guardrail
+    )
+
+    # Only pay for serializing the response when it will actually be logged
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('\n[Full Response]\n%s', orjson.dumps(model_response, option=orjson.OPT_INDENT_2).decode())
+    return model_response
+
+async def nova_verdict_async(client, messages, attempts=MAX_NOVA_ATTEMPTS):
+    """nova_verdict() on an aiobotocore client."""
+    for attempt in range(attempts):
+        try:
+            verdict = parse_verdict(response_text(await converse_nova_async(client, messages)))
+            if verdict is not None:
+                return verdict
+            # If it's anything else, re-try
+            logger.error('Unexpected response. Retrying...')
+
+        except Exception as e:
+            if not is_throttled(e):
+                # Log the error with its stack trace, then raise the error
+                logger.exception('Bedrock converse failed: %s', e)
+                raise
+            # The client has already retried the throttling with adaptive backoff
+            logger.warning('Model request still throttled after client retries; assuming NONE')
+            return FALLBACK_NONE
+
+        if attempt + 1 < attempts:
+            await asyncio.sleep(retry_delay(attempt))
+
+    logger.warning('No valid response from the model after %d attempts; assuming NONE', attempts)
+    return FALLBACK_NONE
+
+async def guarded_verdicts_async(client, guarded_messages, messages):
+    """guarded_verdicts() on an aiobotocore client."""
+    model_response = await converse_nova_async(client, guarded_messages, NOVA_GUARDRAIL_CONFIG)
+    if model_response['stopReason'] == 'guardrail_intervened':
+        if not NOVA_RECHECK_INTERVENED:
+            return 'GUARDRAIL_INTERVENED', 'NONE'
+        return 'GUARDRAIL_INTERVENED', await nova_verdict_async(client, messages)
+
+    verdict = parse_verdict(response_text(model_response))
+    if verdict is None:
+        logger.error('Unexpected response. Retrying...')
+        await asyncio.sleep(retry_delay(0))
+        verdict = await nova_verdict_async(client, messages, MAX_NOVA_ATTEMPTS - 1)
+    return 'NONE', verdict
+
+@cached_verdict_async
+async def guard_nova_text_async(client, guard_content: str):
+    return await guarded_verdicts_async(client, *nova_text_messages(guard_content))
+
+@cached_verdict_async
+async def guard_nova_image_async(client, guard_blob, img_format: Literal['png', 'jpeg']):
+    return await guarded_verdicts_async(client, *nova_image_messages(guard_blob, img_format))
+
+class AsyncGuard:
+    """Async counterpart of guard() on an aiobotocore client. Every guard call is a
+    coroutine on the event loop rather than a pool thread, and all of them share one
+    aiohttp connector of ASYNC_MAX_CONNECTIONS connections. Open it once and share it
+    across requests:
+
+        async with AsyncGuard() as async_guard:
+            decision = await async_guard.guard('hihi', './1.jpg')
+
+    NOVA_TEXT_BATCHING applies to guard() only; here each text is checked on its own.
+    """
+
+    def __init__(self):
+        self.exit_stack = contextlib.AsyncExitStack()
+        self.client = None
+
+    async def __aenter__(self):
+        self.client = await self.exit_stack.enter_async_context(
+            get_session().create_client(
+                'bedrock-runtime',
+                region_name=region,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                aws_session_token=aws_session_token,
+                config=AioConfig(
+                    max_pool_connections=ASYNC_MAX_CONNECTIONS,
+                    retries={'max_attempts': 3, 'mode': 'adaptive'},
+                    connect_timeout=3,
+                    read_timeout=10
+                )
+            )
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.exit_stack.aclose()
+
+    async def guard(self, guard_content=None, img_path=None):
+        """Decides if any guard (text/image) triggers an intervention, storing outcome in decision."""
+        decision = {'guardrails': 'NONE', 'nova': 'NONE'}
+        tasks = {}
 
-    return decision
+        # 1. Check text (if provided); it starts while the image is being read
+        if guard_content is not None:
+            tasks[asyncio.ensure_future(guard_nova_text_async(self.client, guard_content))] = ('guardrails', 'nova')
+
+        # 2. Check image (if provided)
+        image = await asyncio.to_thread(handle_image, img_path) if img_path is not None else None
+        if image is not None:
+            tasks[asyncio.ensure_future(guard_nova_image_async(self.client, *image))] = ('guardrails', 'nova')
+
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    record_verdicts(decision, tasks[task], task.result())
+                if short_circuits(decision):
+                    break
+        finally:
+            # Calls still in flight are cancelled, not waited for; once they have
+            # unwound nothing reads the image mapping any more
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if image is not None:
+                image[0].close()
+
+        return decision
+
+async def guard_async(guard_content=None, img_path=None):
+    """One-off async guard(): opens an AsyncGuard for this call only. Services should keep
+    one AsyncGuard open instead, so its connections are reused across requests."""
+    async with AsyncGuard() as async_guard:
+        return await async_guard.guard(guard_content, img_path)
+
+@functools.cache
+def batch_clients():
+    """Control-plane and storage clients for batch inference, created on first use so
+    callers that never submit a batch do not pay for them; returns (bedrock, s3)."""
+    return session.client('bedrock'), session.client('s3')
+
+def batch_record(record_id, content_blocks):
+    """One batch inference input line: a Nova request in the model's native format."""
+    return {
+        'recordId': record_id,
+        'modelInput': {
+            'schemaVersion': 'messages-v1',
+            'system': list(NOVA_SYSTEM),
+            'messages': [
+                {
+                    'role': 'user',
+                    'content': content_blocks,
+                }
+            ],
+            'inferenceConfig': {
+                'max_new_tokens': NOVA_INF_PARAMS['maxTokens'],
+                'top_p': NOVA_INF_PARAMS['topP'],
+                'temperature': NOVA_INF_PARAMS['temperature'],
+                'top_k': NOVA_EXTRA_FIELDS['inferenceConfig']['topK']
+            }
+        }
+    }
+
+def guard_batch(items: list[dict], s3_bucket: str, role_arn: str):
+    """Submits many items to Nova as one Bedrock batch inference job, for offline
+    moderation of large corpora at batch pricing. Each item is a dict with an optional
+    'guard_content' and/or 'img_path', as for guard(). Batch jobs cannot apply the
+    guardrail, so only Nova's verdict is produced; Bedrock also requires a minimum
+    number of records per job (see its quotas). Returns a job handle for poll_batch()."""
+    bedrock, s3 = batch_clients()
+    # Unique per submission, so concurrent jobs never share a name or S3 prefix
+    job_name = f'guard-batch-{int(time.time())}-{uuid.uuid4().hex[:8]}'
+    prefix = f'guard-batch/{job_name}/'
+
+    with tempfile.NamedTemporaryFile('wb', suffix='.jsonl') as f:
+        for i, item in enumerate(items):
+            # Record ids are 11 alphanumeric characters: modality, then item index
+            if item.get('guard_content') is not None:
+                blocks = [{'text': NOVA_TEXT_PREFIX + item['guard_content'] + NOVA_TEXT_SUFFIX}]
+                f.write(orjson.dumps(batch_record(f'T{i:010d}', blocks)) + b'\n')
+
+            image = handle_image(item['img_path']) if item.get('img_path') is not None else None
+            if image is not None:
+                img_blob, ext = image
+                try:
+                    blocks = [
+                        NOVA_IMAGE_PROMPT_BLOCK,
+                        {'image': {'format': ext, 'source': {'bytes': base64.b64encode(img_blob).decode()}}}
+                    ]
+                    f.write(orjson.dumps(batch_record(f'I{i:010d}', blocks)) + b'\n')
+                finally:
+                    img_blob.close()
+
+        f.flush()
+        s3.upload_file(f.name, s3_bucket, prefix + 'input.jsonl')
+
+    response = bedrock.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=MODEL_ID,
+        inputDataConfig={'s3InputDataConfig': {'s3Uri': f's3://{s3_bucket}/{prefix}input.jsonl'}},
+        outputDataConfig={'s3OutputDataConfig': {'s3Uri': f's3://{s3_bucket}/{prefix}output/'}}
+    )
+    return {'job_arn': response['jobArn'], 's3_bucket': s3_bucket, 'prefix': prefix, 'count': len(items)}
+
+def poll_batch(job):
+    """Returns one {'nova': ...} decision per item submitted with guard_batch(), in order,
+    or None while the job is still running."""
+    bedrock, s3 = batch_clients()
+    status = bedrock.get_model_invocation_job(jobIdentifier=job['job_arn'])['status']
+    if status not in ('Completed', 'PartiallyCompleted'):
+        if status in ('Failed', 'Stopping', 'Stopped', 'Expired'):
+            raise RuntimeError(f'Batch job {job["job_arn"]} ended with status {status}')
+        return None
+
+    # Bedrock writes results under the output prefix, in a folder named after the job id
+    job_id = job['job_arn'].rsplit('/', 1)[-1]
+    output = s3.get_object(
+        Bucket=job['s3_bucket'],
+        Key=f'{job["prefix"]}output/{job_id}/input.jsonl.out'
+    )
+
+    decisions = [{'nova': 'NONE'} for _ in range(job['count'])]
+    for line in output['Body'].iter_lines():
+        record = orjson.loads(line)
+        if 'modelOutput' not in record:
+            logger.warning('Batch record %s failed: %s', record['recordId'], record.get('error'))
+            continue
+        verdict = parse_verdict(record['modelOutput']['output']['message']['content'][0]['text'])
+        if verdict == 'GUARDRAIL_INTERVENED':
+            decisions[int(record['recordId'][1:])]['nova'] = 'GUARDRAIL_INTERVENED'
+
+    return decisions
 
 def main():
     """
@@ -334,6 +979,13 @@ def main():
     logging.info(decision)
     decision = guard('fuck fuck fuck','./cancer.jpeg')
     logging.info(decision)
+
+    From async code, keep an AsyncGuard open and await its guard(...) with the same
+    arguments; a script can run a single check with asyncio.run(guard_async('hihi')).
+
+    For offline moderation of a large corpus, submit a batch job and poll it:
+    job = guard_batch([{'guard_content': 'hihi'}, {'img_path': './1.jpg'}], bucket, role_arn)
+    decisions = poll_batch(job)
     """
     pass
 